@@ -2,19 +2,29 @@ import streamlit as st
 import streamlit.components.v1 as components
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import exceptions
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import pytz
+import hashlib
+import html
+import json
+import hmac
+from zoneinfo import ZoneInfo
 import requests
 import pandas as pd
 from streamlit_autorefresh import st_autorefresh
 
 # --- 1. SETUP FIREBASE ---
-if not firebase_admin._apps:
-    key_dict = dict(st.secrets["firebase"])
-    cred = credentials.Certificate(key_dict)
-    firebase_admin.initialize_app(cred)
+@st.cache_resource
+def get_db():
+    """Initializes Firebase once per process and shares the Firestore client across reruns"""
+    if not firebase_admin._apps:
+        key_dict = dict(st.secrets["firebase"])
+        cred = credentials.Certificate(key_dict)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
 
-db = firestore.client()
+db = get_db()
 
 if 'active_action' not in st.session_state:
     st.session_state['active_action'] = None
@@ -24,51 +34,87 @@ if 'active_action' not in st.session_state:
 if not st.session_state.get('active_action'):
     st_autorefresh(interval=30000, key="data_refresh")
 
-IST = pytz.timezone('Asia/Kolkata')
+IST = ZoneInfo('Asia/Kolkata')
 MASTER_PIN = st.secrets["general"]["master_pin"]
 BUFFER_MINUTES = 15
+MAX_QUEUE = 20
+DESIGNATIONS = ["PhD", "PDF", "Project Student", "Visitor"]
+
+# Template for the urgent reason shown in queue entries (the reason is escaped before formatting)
+URGENT_REASON_HTML = ":fire: <span class='urgent-text'>{}</span>"
 
 # TELEGRAM CONFIG
 BOT_TOKEN = st.secrets["telegram"]["bot_token"]
 CHAT_ID_KRITIKA = st.secrets["telegram"]["chat_id_kritika"]
 CHAT_ID_ROHINI = st.secrets["telegram"]["chat_id_rohini"]
+TELEGRAM_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
 
 # --- 3. NOTIFICATION SYSTEMS ---
 
-def send_telegram(message, hostel_name):
-    """Sends a message to the Telegram Group"""
+@st.cache_resource
+def get_telegram_session():
+    """Keeps one HTTP session per process so alerts reuse the TLS connection to Telegram"""
+    return requests.Session()
+
+@st.cache_resource
+def get_telegram_executor():
+    """A single background worker, so alerts never delay the page and still arrive in order"""
+    return ThreadPoolExecutor(max_workers=1)
+
+def post_telegram(session, payload):
+    """Runs on the background worker; failures are only logged"""
     try:
-        chat_id = CHAT_ID_KRITIKA if hostel_name == "Kritika Hostel" else CHAT_ID_ROHINI
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": f"[{hostel_name}] {message}",
-            "parse_mode": "Markdown"
-        }
-        requests.post(url, json=payload)
+        session.post(TELEGRAM_URL, json=payload, timeout=3)
     except Exception as e:
         print(f"Telegram Error: {e}")
 
+def send_telegram(message, hostel_name):
+    """Sends a message to the Telegram Group without waiting for the reply"""
+    chat_id = CHAT_ID_KRITIKA if hostel_name == "Kritika Hostel" else CHAT_ID_ROHINI
+    payload = {
+        "chat_id": chat_id,
+        "text": f"[{hostel_name}] {message}",
+        "parse_mode": "Markdown"
+    }
+    try:
+        get_telegram_executor().submit(post_telegram, get_telegram_session(), payload)
+    except RuntimeError as e:
+        print(f"Telegram Error: {e}")
+
+# Built once; title and body are substituted as escaped JS string literals
+NOTIFICATION_JS = """
+<script>
+    function sendNotification() {
+        var title = %(title)s;
+        var options = {
+            body: %(body)s,
+            icon: "https://cdn-icons-png.flaticon.com/512/2954/2954888.png",
+            requireInteraction: true
+        };
+        if (Notification.permission === "granted") {
+            new Notification(title, options);
+        }
+    }
+    sendNotification();
+</script>
+"""
+
+def js_string(text):
+    """JSON-encodes text as a JS string literal that can't close the surrounding <script> tag"""
+    return json.dumps(text).replace("</", "<\\/")
+
 def trigger_browser_notification(title, body):
     """Triggers a local browser notification"""
-    js_code = f"""
-    <script>
-        function sendNotification() {{
-            var title = "{title}";
-            var options = {{
-                body: "{body}",
-                icon: "https://cdn-icons-png.flaticon.com/512/2954/2954888.png",
-                requireInteraction: true
-            }};
-            if (Notification.permission === "granted") {{
-                new Notification(title, options);
-            }}
-        }}
-        sendNotification();
-    </script>
-    """
+    js_code = NOTIFICATION_JS % {"title": js_string(title), "body": js_string(body)}
     components.html(js_code, height=0, width=0)
 
+def notify_once(signature, title, body):
+    """Triggers a browser notification at most once per session for a given event"""
+    fired = st.session_state.setdefault('fired_notifications', set())
+    if signature not in fired:
+        fired.add(signature)
+        trigger_browser_notification(title, body)
+
 def request_permission_button():
     components.html("""
     <script>
@@ -91,28 +137,216 @@ def request_permission_button():
 def get_current_time():
     return datetime.now(IST)
 
+def to_datetime(value):
+    """Times are stored as Firestore timestamps; older documents still hold ISO strings"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
 def format_time(dt):
-    if isinstance(dt, str):
-        dt = datetime.fromisoformat(dt)
-    return dt.strftime("%I:%M %p")
+    return to_datetime(dt).astimezone(IST).strftime("%I:%M %p")
+
+def hash_pin(pin):
+    """PINs are stored as a keyed BLAKE2 digest, never in plaintext"""
+    return hashlib.blake2s(pin.encode(), key=str(MASTER_PIN).encode()[:32], digest_size=16).hexdigest()
+
+def is_master_pin(pin):
+    return hmac.compare_digest(pin.encode(), str(MASTER_PIN).encode())
+
+def is_pin_digest(stored_pin):
+    """True for values written by hash_pin (32 hex characters)"""
+    return len(stored_pin) == 32 and all(c in "0123456789abcdef" for c in stored_pin)
+
+def pin_matches(pin_input, stored_pin):
+    """Constant-time check against the stored digest (or a pre-hashing plaintext PIN) and the master PIN"""
+    if is_master_pin(pin_input):
+        return True
+    if is_pin_digest(stored_pin):
+        return hmac.compare_digest(hash_pin(pin_input).encode(), stored_pin.encode())
+    # Entries stored before hashing hold the PIN itself; they disappear as those sessions and queue spots end
+    return hmac.compare_digest(pin_input.encode(), stored_pin.encode())
+
+def machine_log(machine, user, designation, duration_mins, timestamp):
+    return {
+        "timestamp": timestamp.isoformat(),
+        "machine": machine,
+        "user": user,
+        "designation": designation,
+        "duration_mins": duration_mins
+    }
+
+def write_log(writer, log):
+    """Adds a (log collection, log data) entry to a batch or transaction so it commits with the state change"""
+    if log:
+        log_collection, log_data = log
+        writer.set(db.collection(log_collection).document(), log_data)
+
+@firestore.transactional
+def claim_turn(transaction, doc_ref, name, user_data, log=None):
+    """Atomically takes the first queue spot (if any) and records the new current user"""
+    snap = doc_ref.get(transaction=transaction)
+    queue = (snap.to_dict() or {}).get("queue", [])
+    fields = {"current_user": user_data}
+    if queue:
+        if queue[0]['name'].strip().lower() != name.strip().lower():
+            raise PermissionError(f"Only {queue[0]['name']} can start!")
+        queue.pop(0)
+        fields["queue"] = queue
+    if snap.exists:
+        # Only touch the changed fields; the old free time must not outlive this session
+        fields["last_free_time"] = firestore.DELETE_FIELD
+        transaction.update(doc_ref, fields)
+    else:
+        transaction.set(doc_ref, fields)
+    write_log(transaction, log)
 
-def add_log(hostel, machine, user, designation, duration_mins):
+@firestore.transactional
+def finish_session(transaction, doc_ref, session, finished_at, log=None):
+    """Ends the current session only if it is still the one that was shown; returns whether it did"""
+    snap = doc_ref.get(transaction=transaction)
+    current = (snap.to_dict() or {}).get("current_user")
+    if not current or current.get("start_time") != session.get("start_time"):
+        return False
+    transaction.update(doc_ref, {"current_user": firestore.DELETE_FIELD, "last_free_time": finished_at})
+    write_log(transaction, log)
+    return True
+
+@firestore.transactional
+def extend_session(transaction, doc_ref, session, minutes):
+    """Adds time to the current session only if it is still the one that was shown; returns whether it did"""
+    snap = doc_ref.get(transaction=transaction)
+    current = (snap.to_dict() or {}).get("current_user")
+    if not current or current.get("start_time") != session.get("start_time"):
+        return False
+    # Extend from the stored end so two concurrent extensions both count
+    new_end = to_datetime(current["end_time"]) + timedelta(minutes=minutes)
+    # Only touch the changed fields; reset alert flag if adding time
+    transaction.update(doc_ref, {
+        "current_user.end_time": new_end,
+        "current_user.end_time_display": format_time(new_end),
+        "current_user.timeout_alert_sent": False
+    })
+    return True
+
+@firestore.transactional
+def join_queue(transaction, doc_ref, entry):
+    """Appends to the queue inside a transaction, refusing once it holds MAX_QUEUE people"""
+    snap = doc_ref.get(transaction=transaction)
+    queue = (snap.to_dict() or {}).get("queue", [])
+    if entry in queue:
+        return
+    if len(queue) >= MAX_QUEUE:
+        raise ValueError(f"The queue is full ({MAX_QUEUE} people). Please try again later.")
+    queue.append(entry)
+    transaction.update(doc_ref, {"queue": queue})
+
+@firestore.transactional
+def swap_down(transaction, doc_ref, entry):
+    """Swaps a queue entry with the one behind it, locating it in the latest queue"""
+    snap = doc_ref.get(transaction=transaction)
+    queue = (snap.to_dict() or {}).get("queue", [])
+    if entry in queue:
+        idx = queue.index(entry)
+        if idx < len(queue) - 1:
+            queue[idx], queue[idx+1] = queue[idx+1], queue[idx]
+            transaction.update(doc_ref, {"queue": queue})
+
+@st.cache_data(ttl=10, show_spinner=False)
+def fetch_machines(collection, names):
+    """Reads all machine documents in one batched call, reused across reruns for a few seconds; update times allow conditional writes"""
+    refs = [db.collection(collection).document(n) for n in names]
+    snaps = list(db.get_all(refs))
+    data = {snap.id: (snap.to_dict() if snap.exists else {}) for snap in snaps}
+    # Parse legacy ISO strings here so cached reruns get ready-to-compare datetimes
+    for machine_data in data.values():
+        if machine_data.get("current_user"):
+            machine_data["current_user"]["end_time"] = to_datetime(machine_data["current_user"]["end_time"])
+        if machine_data.get("last_free_time"):
+            machine_data["last_free_time"] = to_datetime(machine_data["last_free_time"])
+    update_times = {snap.id: snap.update_time for snap in snaps if snap.exists}
+    return data, update_times
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_announcements(doc_ids):
+    """Reads announcement messages in one batched call; they change rarely, so widget reruns reuse them"""
+    refs = [db.collection("announcements").document(d) for d in doc_ids]
+    return {snap.id: (snap.to_dict() or {}).get("message") for snap in db.get_all(refs) if snap.exists}
+
+def render_queue(queue, doc_ref, key_suffix):
+    """Shows the queue with per-entry Swap Down / Leave controls (shared by laundry and pantry)"""
+    st.divider()
+    st.write(f"**Queue ({len(queue)})**")
+    for idx, q_user in enumerate(queue[:MAX_QUEUE]):
+        urgency_icon = "🔥" if q_user.get('urgent') else ""
+        desig_str = q_user.get('designation', '')
+        name_str = f"{q_user['name']} ({desig_str})" if desig_str else q_user['name']
+        
+        with st.expander(f"{idx+1}. {name_str} {urgency_icon}"):
+            if q_user.get('urgent_reason'):
+                st.markdown(URGENT_REASON_HTML.format(html.escape(q_user['urgent_reason'])), unsafe_allow_html=True)
+            if q_user.get('comment'):
+                st.info(f"📝 Note: {q_user['comment']}")
+            
+            with st.form(f"qform_{key_suffix}_{idx}", border=False, enter_to_submit=False):
+                action_pin = st.text_input("PIN", type="password", key=f"qpin_{key_suffix}_{idx}")
+                c_swap, c_leave = st.columns(2)
+                with c_swap:
+                    swap_btn = idx < len(queue) - 1 and st.form_submit_button(f"▼ Swap Down", key=f"swap_{key_suffix}_{idx}")
+                with c_leave:
+                    leave_btn = st.form_submit_button("❌ Leave", key=f"lv_{key_suffix}_{idx}")
+            
+            if swap_btn:
+                if pin_matches(action_pin, q_user['pin']):
+                    swap_down(db.transaction(), doc_ref, q_user)
+                    fetch_machines.clear()
+                    st.rerun()
+            
+            if leave_btn:
+                if pin_matches(action_pin, q_user['pin']):
+                    doc_ref.update({"queue": firestore.ArrayRemove([q_user])})
+                    fetch_machines.clear()
+                    st.rerun()
+
+def queue_join_fields(comment_placeholder):
+    """Renders the Join Queue inputs shared by the laundry and pantry forms"""
+    q_name = st.text_input("Name *")
+    q_desig = st.selectbox("Designation *", DESIGNATIONS)
+    q_comment = st.text_input("Comment (Optional)", placeholder=comment_placeholder)
+    q_is_urgent = st.checkbox("🔥 Urgent?")
+    q_reason = st.text_input("Reason") if q_is_urgent else ""
+    q_pin = st.text_input("PIN *", type="password")
+    return q_name, q_desig, q_comment, q_is_urgent, q_reason, q_pin
+
+def submit_queue_join(doc_ref, join_fields, alert_title, target, hostel_name):
+    """Validates a Join Queue submission, adds it to the queue and announces it; returns True on success"""
+    q_name, q_desig, q_comment, q_is_urgent, q_reason, q_pin = join_fields
+    if not q_name.strip() or not q_pin.strip():
+        st.error("⚠️ Please fill in all mandatory fields (Name and PIN).")
+        return False
+    data = {"name": q_name, "designation": q_desig, "comment": q_comment, "pin": hash_pin(q_pin), "urgent": q_is_urgent, "urgent_reason": q_reason}
     try:
-        log_data = {
-            "timestamp": get_current_time().isoformat(),
-            "machine": machine,
-            "user": user,
-            "designation": designation,
-            "duration_mins": duration_mins
-        }
-        db.collection(f"{hostel}_logs").add(log_data)
-    except Exception as e:
-        print(f"Log error: {e}")
+        join_queue(db.transaction(), doc_ref, data)
+    except ValueError as e:
+        st.error(str(e))
+        return False
+    alert = f"{alert_title}\n👤 User: {q_name} joined queue for {target}."
+    if q_comment.strip(): alert += f"\n📝 *Note:* _{q_comment.strip()}_"
+    if q_is_urgent: alert += f"\n🔥 *URGENT*: {q_reason}"
+    send_telegram(alert, hostel_name)
+    return True
+
+def set_session_value(key, value):
+    """Button callback: runs before the rerun the click already triggers, so no extra st.rerun() is needed"""
+    st.session_state[key] = value
 
 # Initialize Session State for Change Detection
 if 'machine_states' not in st.session_state:
     st.session_state['machine_states'] = {}
 
+# One timestamp per rerun so every status check and write in this run agrees
+now = get_current_time()
+now_iso = now.isoformat()
+
 # --- 5. APP INTERFACE ---
 st.set_page_config(page_title="Hostel Laundry", page_icon="🧺", layout="wide")
 
@@ -129,7 +363,7 @@ if page == "Announcements":
         auth_pin = st.text_input("Master PIN", type="password")
         auth_submit = st.form_submit_button("Enter")
         
-    if auth_pin == MASTER_PIN:
+    if auth_pin and is_master_pin(auth_pin):
         target_hostel = st.selectbox("Target Hostel", ["Kritika Hostel", "Rohini Hostel", "Both"])
         target_category = st.selectbox("Target Category", ["Laundry", "First Aid", "Pantry", "All Categories"])
         msg = st.text_area("Announcement Message")
@@ -140,7 +374,8 @@ if page == "Announcements":
             
             for h in hostels:
                 for c in categories:
-                    db.collection("announcements").document(f"{h}_{c}").set({"message": msg, "timestamp": get_current_time().isoformat()})
+                    db.collection("announcements").document(f"{h}_{c}").set({"message": msg, "timestamp": now_iso})
+            fetch_announcements.clear()
             st.success("Published!")
             
         st.write("---")
@@ -149,12 +384,16 @@ if page == "Announcements":
             hostels = ["Kritika Hostel", "Rohini Hostel"]
             categories = ["Laundry", "First Aid", "Pantry"]
             
+            # Read all announcement documents in one batched call
+            ann_refs = [db.collection("announcements").document(f"{h}_{c}") for h in hostels for c in categories]
+            ann_snaps = {snap.id: snap for snap in db.get_all(ann_refs)}
+            
             any_exists = False
             for h in hostels:
                 st.write(f"#### {h}")
                 for c in categories:
                     doc_id = f"{h}_{c}"
-                    doc = db.collection("announcements").document(doc_id).get()
+                    doc = ann_snaps[doc_id]
                     
                     c1, c2 = st.columns([4, 1])
                     with c1:
@@ -164,6 +403,7 @@ if page == "Announcements":
                             any_exists = True
                             if st.button(f"Clear", key=f"clear_{doc_id}", use_container_width=True):
                                 db.collection("announcements").document(doc_id).delete()
+                                fetch_announcements.clear()
                                 st.rerun()
             
             st.write("<br>", unsafe_allow_html=True)
@@ -171,6 +411,7 @@ if page == "Announcements":
                 for h in hostels:
                     for c in categories:
                         db.collection("announcements").document(f"{h}_{c}").delete()
+                fetch_announcements.clear()
                 st.rerun()
         except Exception:
             pass
@@ -204,7 +445,7 @@ if page == "Usage Logs":
             if logs:
                 formatted_logs = []
                 for log in logs:
-                    dt_obj = datetime.fromisoformat(log.get('timestamp', get_current_time().isoformat()))
+                    dt_obj = datetime.fromisoformat(log.get('timestamp', now_iso))
                     if log_category == "Laundry":
                         formatted_logs.append({
                             "Date & Time": dt_obj.strftime("%Y-%m-%d %I:%M %p"),
@@ -275,18 +516,14 @@ if not selected_hostel or not selected_category:
 
 try:
     doc_id = f"{selected_hostel}_{selected_category}"
-    announcement_doc = db.collection("announcements").document(doc_id).get()
-    if announcement_doc.exists:
-        ann_data = announcement_doc.to_dict()
-        if ann_data and ann_data.get("message"):
-            st.warning(f"📢 **{selected_category} Announcement:** {ann_data['message']}")
+    # Category and generic hostel announcements are read in one batched (cached) call
+    announcements = fetch_announcements((doc_id, selected_hostel))
+    if announcements.get(doc_id):
+        st.warning(f"📢 **{selected_category} Announcement:** {announcements[doc_id]}")
             
     # Fallback to check generic hostel announcement for backward compatibility
-    gen_doc = db.collection("announcements").document(selected_hostel).get()
-    if gen_doc.exists:
-        gen_data = gen_doc.to_dict()
-        if gen_data and gen_data.get("message"):
-            st.warning(f"📢 **Hostel Announcement:** {gen_data['message']}")
+    if announcements.get(selected_hostel):
+        st.warning(f"📢 **Hostel Announcement:** {announcements[selected_hostel]}")
 except Exception:
     pass
 
@@ -301,7 +538,7 @@ if selected_category == "First Aid":
     st.write("Please log the items you have used from the First Aid Kit.")
     with st.form("first_aid_form"):
         fa_name = st.text_input("Name *")
-        fa_desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"])
+        fa_desig = st.selectbox("Designation *", DESIGNATIONS)
         fa_used = st.text_area("Things Used (Comments) *", placeholder="e.g., Band-Aids, Antiseptic cream")
         
         fa_submit = st.form_submit_button("Log Usage", type="primary", use_container_width=True)
@@ -312,7 +549,7 @@ if selected_category == "First Aid":
         else:
             hostel_col = "firstaid_kritika" if selected_hostel == "Kritika Hostel" else "firstaid_rohini"
             log_data = {
-                "timestamp": get_current_time().isoformat(),
+                "timestamp": now_iso,
                 "user": fa_name,
                 "designation": fa_desig,
                 "things_used": fa_used
@@ -331,39 +568,23 @@ elif selected_category == "Pantry":
     
     current_user = p_data.get("current_user", None)
     queue = p_data.get("queue", [])
-    last_free_time_str = p_data.get("last_free_time", None)
+    last_free_time = p_data.get("last_free_time", None)
 
     # State: Join Queue
     if st.session_state.get('pantry_action') == 'Join Queue':
         st.markdown("### Join Pantry Queue")
         with st.container(border=True):
-            q_name = st.text_input("Name *")
-            q_desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"])
-            q_comment = st.text_input("Comment (Optional)", placeholder="e.g., Making tea")
-            q_is_urgent = st.checkbox("🔥 Urgent?")
-            q_reason = st.text_input("Reason") if q_is_urgent else ""
-            q_pin = st.text_input("PIN *", type="password")
+            join_fields = queue_join_fields("e.g., Making tea")
             
             c1, c2 = st.columns(2)
             with c1:
                 submitted = st.button("Confirm", use_container_width=True, type="primary")
             with c2:
-                if st.button("✖ Cancel", use_container_width=True):
-                    st.session_state['pantry_action'] = None
-                    st.rerun()
+                st.button("✖ Cancel", use_container_width=True, on_click=set_session_value, args=('pantry_action', None))
 
-        if submitted:
-            if not q_name.strip() or not q_pin.strip():
-                st.error("⚠️ Please fill in all mandatory fields (Name and PIN).")
-            else:
-                data = {"name": q_name, "designation": q_desig, "comment": q_comment, "pin": q_pin, "urgent": q_is_urgent, "urgent_reason": q_reason}
-                doc_ref.update({"queue": firestore.ArrayUnion([data])})
-                alert = f"🍳 *Pantry Queue Update*\n👤 User: {q_name} joined queue for Pantry."
-                if q_comment.strip(): alert += f"\n📝 *Note:* _{q_comment.strip()}_"
-                if q_is_urgent: alert += f"\n🔥 *URGENT*: {q_reason}"
-                send_telegram(alert, selected_hostel)
-                st.session_state['pantry_action'] = None
-                st.rerun()
+        if submitted and submit_queue_join(doc_ref, join_fields, "🍳 *Pantry Queue Update*", "Pantry", selected_hostel):
+            st.session_state['pantry_action'] = None
+            st.rerun()
         st.stop()
 
     # State: Start Queue
@@ -371,7 +592,7 @@ elif selected_category == "Pantry":
         st.markdown(f"### Start Using Pantry ({queue[0]['name']})")
         with st.container(border=True):
             sp_name = st.text_input("Name *", value=queue[0]['name'])
-            sp_desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"], index=["PhD", "PDF", "Project Student", "Visitor"].index(queue[0]['designation']) if queue[0]['designation'] in ["PhD", "PDF", "Project Student", "Visitor"] else 0)
+            sp_desig = st.selectbox("Designation *", DESIGNATIONS, index=DESIGNATIONS.index(queue[0]['designation']) if queue[0]['designation'] in DESIGNATIONS else 0)
             sp_comments = st.text_input("Comments (equipments used etc.)", value=queue[0].get('comment', ''))
             sp_pin = st.text_input("PIN *", type="password")
             
@@ -379,9 +600,7 @@ elif selected_category == "Pantry":
             with c1:
                 sp_submit = st.button("Mark as In Use", use_container_width=True, type="primary")
             with c2:
-                if st.button("✖ Cancel", use_container_width=True):
-                    st.session_state['pantry_action'] = None
-                    st.rerun()
+                st.button("✖ Cancel", use_container_width=True, on_click=set_session_value, args=('pantry_action', None))
 
         if sp_submit:
             if not sp_name.strip() or not sp_pin.strip():
@@ -389,21 +608,25 @@ elif selected_category == "Pantry":
             elif sp_name.strip().lower() != queue[0]['name'].strip().lower():
                 st.error(f"Only {queue[0]['name']} can start!")
             else:
-                queue.pop(0)
                 user_data = {
                     "name": sp_name,
                     "designation": sp_desig,
                     "comments": sp_comments,
-                    "pin": sp_pin,
-                    "start_time": get_current_time().isoformat()
+                    "pin": hash_pin(sp_pin),
+                    "start_time": now,
+                    "start_time_display": format_time(now)
                 }
-                doc_ref.set({"current_user": user_data, "queue": queue})
-                msg = f"🍳 *Pantry In Use*\n👤 {sp_name}"
-                if sp_comments.strip():
-                    msg += f"\n📝 Equipment: {sp_comments}"
-                send_telegram(msg, selected_hostel)
-                st.session_state['pantry_action'] = None
-                st.rerun()
+                try:
+                    claim_turn(db.transaction(), doc_ref, sp_name, user_data)
+                except PermissionError as e:
+                    st.error(str(e))
+                else:
+                    msg = f"🍳 *Pantry In Use*\n👤 {sp_name}"
+                    if sp_comments.strip():
+                        msg += f"\n📝 Equipment: {sp_comments}"
+                    send_telegram(msg, selected_hostel)
+                    st.session_state['pantry_action'] = None
+                    st.rerun()
         st.stop()
 
     # Main Pantry View
@@ -412,44 +635,43 @@ elif selected_category == "Pantry":
         st.error(f"🔴 IN USE BY: {current_user['name']} ({current_user['designation']})")
         if current_user.get('comments'):
             st.info(f"📝 Equipment Used / Comments: {current_user['comments']}")
-        st.write(f"🕒 Started at: {format_time(current_user['start_time'])}")
+        st.write(f"🕒 Started at: {current_user.get('start_time_display') or format_time(current_user['start_time'])}")
         
         with st.expander("⚙️ Finish Cooking"):
-            fin_pin = st.text_input("PIN *", type="password", key="fin_pin_pantry")
-            fin_submit = st.button("Mark as Not In Use", type="primary", use_container_width=True, key="fin_submit_pantry")
+            with st.form("finish_pantry", border=False):
+                fin_pin = st.text_input("PIN *", type="password", key="fin_pin_pantry")
+                fin_submit = st.form_submit_button("Mark as Not In Use", type="primary", use_container_width=True, key="fin_submit_pantry")
             
         if fin_submit:
-            if fin_pin == current_user['pin'] or fin_pin == MASTER_PIN:
-                doc_ref.update({
-                    "current_user": firestore.DELETE_FIELD,
-                    "last_free_time": get_current_time().isoformat()
-                })
-                start_dt = datetime.fromisoformat(current_user['start_time'])
-                duration = int((get_current_time() - start_dt).total_seconds() / 60)
+            if pin_matches(fin_pin, current_user['pin']):
+                start_dt = to_datetime(current_user['start_time'])
+                duration = int((now - start_dt).total_seconds() / 60)
                 log_data = {
-                    "timestamp": get_current_time().isoformat(),
+                    "timestamp": now_iso,
                     "user": current_user['name'],
                     "designation": current_user['designation'],
                     "comments": current_user['comments'],
                     "duration_mins": duration
                 }
-                db.collection(f"{hostel_id}_logs").add(log_data)
-                msg = f"🍳 *Pantry Free*\n✅ {current_user['name']} finished cooking."
-                if queue: msg += f"\n👉 Next: *{queue[0]['name']}*"
-                send_telegram(msg, selected_hostel)
-                trigger_browser_notification(f"[{selected_hostel}] ✅ Pantry Free!", "Pantry is available.")
+                # Session end and its log entry commit together; skipped if someone else already ended it
+                if finish_session(db.transaction(), doc_ref, current_user, now, log=(f"{hostel_id}_logs", log_data)):
+                    msg = f"🍳 *Pantry Free*\n✅ {current_user['name']} finished cooking."
+                    if queue: msg += f"\n👉 Next: *{queue[0]['name']}*"
+                    send_telegram(msg, selected_hostel)
+                    trigger_browser_notification(f"[{selected_hostel}] ✅ Pantry Free!", "Pantry is available.")
                 st.rerun()
             else:
                 st.error("⚠️ Incorrect PIN.")
     else:
         st.success("🟢 PANTRY IS AVAILABLE")
+        # The claim buffer only matters when someone is waiting
         effective_free_time = None
-        if last_free_time_str:
-            effective_free_time = datetime.fromisoformat(last_free_time_str)
+        if queue and last_free_time:
+            effective_free_time = to_datetime(last_free_time)
 
         if queue and effective_free_time:
             buffer_deadline = effective_free_time + timedelta(minutes=BUFFER_MINUTES)
-            mins_left = int((buffer_deadline - get_current_time()).total_seconds() / 60)
+            mins_left = int((buffer_deadline - now).total_seconds() / 60)
             
             if mins_left > 0:
                 st.warning(f"⏳ **{queue[0]['name']}** has {mins_left} mins to claim.")
@@ -459,7 +681,7 @@ elif selected_category == "Pantry":
                 
                 if len(queue) == 1:
                     timed_out_user = queue.pop(0)
-                    doc_ref.update({"queue": queue, "last_free_time": get_current_time().isoformat()})
+                    doc_ref.update({"queue": firestore.ArrayRemove([timed_out_user]), "last_free_time": now})
                     send_telegram(f"⚠️ *Pantry Queue Alert*\n{timed_out_user['name']} timed out and was automatically removed from the queue.", selected_hostel)
                     st.rerun()
         
@@ -467,7 +689,7 @@ elif selected_category == "Pantry":
             st.markdown("### Start Using Pantry")
             with st.form("start_pantry"):
                 sp_name = st.text_input("Name *")
-                sp_desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"])
+                sp_desig = st.selectbox("Designation *", DESIGNATIONS)
                 sp_comments = st.text_input("Comments (equipments used etc.)", placeholder="e.g., Induction stove, Pan")
                 sp_pin = st.text_input("PIN *", type="password")
                 
@@ -481,46 +703,24 @@ elif selected_category == "Pantry":
                         "name": sp_name,
                         "designation": sp_desig,
                         "comments": sp_comments,
-                        "pin": sp_pin,
-                        "start_time": get_current_time().isoformat()
+                        "pin": hash_pin(sp_pin),
+                        "start_time": now,
+                        "start_time_display": format_time(now)
                     }
-                    doc_ref.set({"current_user": user_data, "queue": queue})
-                    msg = f"🍳 *Pantry In Use*\n👤 {sp_name}"
-                    if sp_comments.strip():
-                        msg += f"\n📝 Equipment: {sp_comments}"
-                    send_telegram(msg, selected_hostel)
-                    st.rerun()
+                    try:
+                        claim_turn(db.transaction(), doc_ref, sp_name, user_data)
+                    except PermissionError as e:
+                        st.error(str(e))
+                    else:
+                        msg = f"🍳 *Pantry In Use*\n👤 {sp_name}"
+                        if sp_comments.strip():
+                            msg += f"\n📝 Equipment: {sp_comments}"
+                        send_telegram(msg, selected_hostel)
+                        st.rerun()
 
     # Queue Display
     if queue:
-        st.divider()
-        st.write(f"**Queue ({len(queue)})**")
-        for idx, q_user in enumerate(queue):
-            urgency_icon = "🔥" if q_user.get('urgent') else ""
-            desig_str = q_user.get('designation', '')
-            name_str = f"{q_user['name']} ({desig_str})" if desig_str else q_user['name']
-            
-            with st.expander(f"{idx+1}. {name_str} {urgency_icon}"):
-                if q_user.get('urgent_reason'):
-                    st.markdown(f":fire: <span class='urgent-text'>{q_user['urgent_reason']}</span>", unsafe_allow_html=True)
-                if q_user.get('comment'):
-                    st.info(f"📝 Note: {q_user['comment']}")
-                
-                action_pin = st.text_input("PIN", type="password", key=f"qpin_pantry_{idx}")
-                c_swap, c_leave = st.columns(2)
-                
-                if idx < len(queue) - 1:
-                    if c_swap.button(f"▼ Swap Down", key=f"swap_pantry_{idx}"):
-                        if action_pin == q_user['pin'] or action_pin == MASTER_PIN:
-                            queue[idx], queue[idx+1] = queue[idx+1], queue[idx]
-                            doc_ref.update({"queue": queue})
-                            st.rerun()
-                
-                if c_leave.button("❌ Leave", key=f"lv_pantry_{idx}"):
-                    if action_pin == q_user['pin'] or action_pin == MASTER_PIN:
-                        queue.pop(idx)
-                        doc_ref.update({"queue": queue})
-                        st.rerun()
+        render_queue(queue, doc_ref, "pantry")
 
     st.divider()
     show_join = False
@@ -534,18 +734,14 @@ elif selected_category == "Pantry":
             st.write(f"**{queue[0]['name']} missed their turn.**")
             if st.button(f"🚀 Skip to {queue[1]['name']}", key="skip_pantry"):
                  timed_out_user = queue.pop(0)
-                 doc_ref.update({"queue": queue, "last_free_time": get_current_time().isoformat()})
+                 doc_ref.update({"queue": firestore.ArrayRemove([timed_out_user]), "last_free_time": now})
                  send_telegram(f"⚠️ *Pantry Queue Alert*\n{timed_out_user['name']} timed out.\n👉 Next: {queue[0]['name']} starts now.", selected_hostel)
                  st.rerun()
 
-        if st.button(f"Start ({queue[0]['name']})", use_container_width=True, key="btn_sq_pantry"):
-            st.session_state['pantry_action'] = 'Start Queue'
-            st.rerun()
+        st.button(f"Start ({queue[0]['name']})", use_container_width=True, key="btn_sq_pantry", on_click=set_session_value, args=('pantry_action', 'Start Queue'))
 
     if show_join:
-        if st.button("Join Queue", use_container_width=True, key="btn_jq_pantry"):
-            st.session_state['pantry_action'] = 'Join Queue'
-            st.rerun()
+        st.button("Join Queue", use_container_width=True, key="btn_jq_pantry", on_click=set_session_value, args=('pantry_action', 'Join Queue'))
 
     st.stop()
 
@@ -566,23 +762,15 @@ if st.session_state.get('active_action'):
     st.markdown(f"### {act_type.replace('_', ' ').title()}")
     
     doc_ref = db.collection(DB_COLLECTION).document(machine_name)
-    doc_snap = doc_ref.get()
-    m_data = doc_snap.to_dict() if doc_snap.exists else {}
-    queue = m_data.get('queue', [])
     
     with st.container(border=True):
         if act_type == 'Join Queue':
-            q_name = st.text_input("Name *")
-            q_desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"])
-            q_comment = st.text_input("Comment (Optional)", placeholder="e.g., Handle with care")
-            q_is_urgent = st.checkbox("🔥 Urgent?")
-            q_reason = st.text_input("Reason") if q_is_urgent else ""
-            q_pin = st.text_input("PIN *", type="password")
+            join_fields = queue_join_fields("e.g., Handle with care")
             
             submitted = st.button("Confirm", use_container_width=True, type="primary")
         else:
             name = st.text_input("Name *")
-            desig = st.selectbox("Designation *", ["PhD", "PDF", "Project Student", "Visitor"])
+            desig = st.selectbox("Designation *", DESIGNATIONS)
             
             dur_choice = st.selectbox("Duration (mins) *", ["30", "45", "60", "90", "120", "Custom (Manual Input)"], index=1)
             if dur_choice == "Custom (Manual Input)":
@@ -595,21 +783,12 @@ if st.session_state.get('active_action'):
             
             submitted = st.button("Start", use_container_width=True, type="primary")
 
-    if st.button("✖ Cancel / Go Back", use_container_width=True):
-        st.session_state['active_action'] = None
-        st.rerun()
+    st.button("✖ Cancel / Go Back", use_container_width=True, on_click=set_session_value, args=('active_action', None))
 
     if submitted:
         if act_type == 'Join Queue':
-            if not q_name.strip() or not q_pin.strip():
-                st.error("⚠️ Please fill in all mandatory fields (Name and PIN).")
-            else:
-                data = {"name": q_name, "designation": q_desig, "comment": q_comment, "pin": q_pin, "urgent": q_is_urgent, "urgent_reason": q_reason}
-                doc_ref.update({"queue": firestore.ArrayUnion([data])})
-                alert = f"📝 *Queue Update*\n👤 User: {q_name} joined queue for {machine_name}."
-                if q_comment.strip(): alert += f"\n📝 *Note:* _{q_comment.strip()}_"
-                if q_is_urgent: alert += f"\n🔥 *URGENT*: {q_reason}"
-                send_telegram(alert, selected_hostel)
+            if submit_queue_join(doc_ref, join_fields, "📝 *Queue Update*", machine_name, selected_hostel):
+                fetch_machines.clear()
                 st.session_state['active_action'] = None
                 st.rerun()
         else:
@@ -618,17 +797,20 @@ if st.session_state.get('active_action'):
             elif act_type == 'Start Queue' and name.strip().lower() != queue_0_name.strip().lower():
                 st.error(f"Only {queue_0_name} can start!")
             else:
-                if act_type == 'Start Queue':
-                    queue.pop(0)
-                end_val = get_current_time() + timedelta(minutes=duration)
-                user_data = {"name": name, "designation": desig, "comment": comment, "pin": pin, "start_time": get_current_time().isoformat(), "end_time": end_val.isoformat(), "timeout_alert_sent": False}
-                doc_ref.set({"current_user": user_data, "queue": queue})
-                add_log(DB_COLLECTION, machine_name, name, desig, duration)
-                msg = f"🧺 *{machine_name} Started*\n👤 User: {name}\n⏱ Duration: {duration} mins"
-                if comment.strip(): msg += f"\n📝 *Note:* _{comment.strip()}_"
-                send_telegram(msg, selected_hostel)
-                st.session_state['active_action'] = None
-                st.rerun()
+                end_val = now + timedelta(minutes=duration)
+                user_data = {"name": name, "designation": desig, "comment": comment, "pin": hash_pin(pin), "start_time": now, "end_time": end_val, "start_time_display": format_time(now), "end_time_display": format_time(end_val), "timeout_alert_sent": False}
+                log = (f"{DB_COLLECTION}_logs", machine_log(machine_name, name, desig, duration, now))
+                try:
+                    claim_turn(db.transaction(), doc_ref, name, user_data, log=log)
+                except PermissionError as e:
+                    st.error(str(e))
+                else:
+                    fetch_machines.clear()
+                    msg = f"🧺 *{machine_name} Started*\n👤 User: {name}\n⏱ Duration: {duration} mins"
+                    if comment.strip(): msg += f"\n📝 *Note:* _{comment.strip()}_"
+                    send_telegram(msg, selected_hostel)
+                    st.session_state['active_action'] = None
+                    st.rerun()
     st.stop()
 
 # CSS Styles
@@ -649,6 +831,15 @@ div[data-testid="InputInstructions"] { display: none !important; }
 </style>
 """, unsafe_allow_html=True)
 
+# Fetch every machine in one batched (and briefly cached) read
+machines_data, machine_update_times = fetch_machines(DB_COLLECTION, tuple(MACHINES))
+
+# "Time's Up" flags for all expired machines are written in a single batch.
+# Each write only applies if the document is unchanged since we read it, so when
+# several viewers notice the same expiry only the first one writes and alerts.
+expiry_batch = db.batch()
+expiry_alerts = []
+
 # Display machines side-by-side on desktop, auto-stacks vertically on mobile
 cols = st.columns(len(MACHINES))
 
@@ -659,12 +850,11 @@ for i, machine_name in enumerate(MACHINES):
             
             # Fetch data
             doc_ref = db.collection(DB_COLLECTION).document(machine_name)
-            doc = doc_ref.get()
-            machine_data = doc.to_dict() if doc.exists else {}
+            machine_data = machines_data.get(machine_name, {})
             
             current_user = machine_data.get("current_user", None)
             queue = machine_data.get("queue", [])
-            last_free_time_str = machine_data.get("last_free_time", None)
+            last_free_time = machine_data.get("last_free_time", None)
             
             # --- LOGIC & TRIGGERS ---
             
@@ -672,11 +862,11 @@ for i, machine_name in enumerate(MACHINES):
             user_name = "None"
             
             if current_user:
-                end_time = datetime.fromisoformat(current_user['end_time'])
+                end_time = current_user['end_time']
                 user_name = current_user['name']
                 
                 # CASE 1: Still Running
-                if get_current_time() < end_time:
+                if now < end_time:
                     is_running = True
                 
                 # CASE 2: Time JUST ran out (Auto-Expiry)
@@ -689,32 +879,29 @@ for i, machine_name in enumerate(MACHINES):
                         if queue: msg += f"\n👉 Next: *{queue[0]['name']}*"
                         else: msg += "\n✅ Machine is now free."
                         
-                        send_telegram(msg, selected_hostel)
-                        trigger_browser_notification(f"[{selected_hostel}] ⏰ Time's Up!", f"{user_name} finished on {machine_name}")
+                        notify_once(f"{selected_hostel}_{machine_name}:{end_time}", f"[{selected_hostel}] ⏰ Time's Up!", f"{user_name} finished on {machine_name}")
                         
-                        # Mark as sent
-                        current_user['timeout_alert_sent'] = True
-                        doc_ref.update({"current_user": current_user})
-                        st.rerun()
+                        # Mark as sent (committed together after the loop); only the flag is written
+                        expiry_batch.update(
+                            doc_ref,
+                            {"current_user.timeout_alert_sent": True},
+                            option=db.write_option(last_update_time=machine_update_times[machine_name])
+                        )
+                        expiry_alerts.append(msg)
 
             # Retrieve Previous State (for Browser Notifications)
+            # Only the running flag feeds a notification, so that's all we remember per machine
             state_key = f"{selected_hostel}_{machine_name}"
-            prev_state = st.session_state['machine_states'].get(state_key, {
-                'is_running': is_running,
-                'queue_len': len(queue),
-                'first_in_line': queue[0]['name'] if queue else None
-            })
+            was_running = st.session_state['machine_states'].get(state_key, is_running)
 
             # Browser Trigger: Machine became free
-            if prev_state['is_running'] and not is_running:
-                trigger_browser_notification(f"[{selected_hostel}] ✅ Machine Free!", f"{machine_name} is available.")
+            # (keyed by the session's end so an expiry already announced as "Time's Up" doesn't fire twice)
+            if was_running and not is_running:
+                freed_at = end_time if current_user else last_free_time
+                notify_once(f"{state_key}:{freed_at}", f"[{selected_hostel}] ✅ Machine Free!", f"{machine_name} is available.")
 
             # Update State
-            st.session_state['machine_states'][state_key] = {
-                'is_running': is_running,
-                'queue_len': len(queue),
-                'first_in_line': queue[0]['name'] if queue else None
-            }
+            st.session_state['machine_states'][state_key] = is_running
 
             # --- DISPLAY UI ---
             if is_running:
@@ -722,38 +909,37 @@ for i, machine_name in enumerate(MACHINES):
                 title_str = f"🔴 BUSY: {current_user['name']} ({desig_str})" if desig_str else f"🔴 BUSY: {current_user['name']}"
                 st.error(title_str)
                 
-                remaining = int((end_time - get_current_time()).total_seconds() / 60)
+                remaining = int((end_time - now).total_seconds() / 60)
                 st.metric("Time Left", f"{remaining} min", delta_color="inverse")
                 
-                avail_time_str = format_time(end_time)
+                avail_time_str = current_user.get('end_time_display') or format_time(end_time)
                 st.write(f"🕒 **Expected Available at:** `{avail_time_str}`")
                 
                 if current_user.get('comment'):
                     st.info(f"📝 Note: {current_user['comment']}")
                 
                 with st.expander("⚙️ Finish early / Extend time"):
-                    c_pin, c_add = st.columns([2, 1])
-                    with c_pin:
-                        pin_input = st.text_input("PIN *", type="password", key=f"pin_{machine_name}")
-                    with c_add:
-                        add_time = st.number_input("Add Mins", min_value=5, value=15, step=5, key=f"time_{machine_name}")
-                    
-                    st.write("") # Spacer
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        add_btn = st.button("Add Time", use_container_width=True, key=f"add_{machine_name}")
-                    with c2:
-                        end_btn = st.button("Finish Early", use_container_width=True, key=f"end_{machine_name}")
+                    # A form so typing the PIN doesn't rerun the page on every keystroke
+                    with st.form(f"manage_{machine_name}", border=False, enter_to_submit=False):
+                        c_pin, c_add = st.columns([2, 1])
+                        with c_pin:
+                            pin_input = st.text_input("PIN *", type="password", key=f"pin_{machine_name}")
+                        with c_add:
+                            add_time = st.number_input("Add Mins", min_value=5, value=15, step=5, key=f"time_{machine_name}")
+                        
+                        st.write("") # Spacer
+                        c1, c2 = st.columns(2)
+                        with c1:
+                            add_btn = st.form_submit_button("Add Time", use_container_width=True, key=f"add_{machine_name}")
+                        with c2:
+                            end_btn = st.form_submit_button("Finish Early", use_container_width=True, key=f"end_{machine_name}")
                         
                     if add_btn:
                         if not pin_input.strip():
                             st.error("⚠️ Please enter PIN.")
-                        elif pin_input == current_user['pin'] or pin_input == MASTER_PIN:
-                            new_end = end_time + timedelta(minutes=add_time)
-                            current_user['end_time'] = new_end.isoformat()
-                            # Reset alert flag if adding time
-                            current_user['timeout_alert_sent'] = False
-                            doc_ref.update({"current_user": current_user})
+                        elif pin_matches(pin_input, current_user['pin']):
+                            extend_session(db.transaction(), doc_ref, current_user, add_time)
+                            fetch_machines.clear()
                             st.rerun()
                         else:
                             st.error("Wrong PIN")
@@ -761,31 +947,32 @@ for i, machine_name in enumerate(MACHINES):
                     if end_btn:
                         if not pin_input.strip():
                             st.error("⚠️ Please enter PIN.")
-                        elif pin_input == current_user['pin'] or pin_input == MASTER_PIN:
-                            doc_ref.update({
-                                "current_user": firestore.DELETE_FIELD,
-                                "last_free_time": get_current_time().isoformat()
-                            })
-                            # MANUAL FINISH ALERT
-                            msg = f"✅ *{machine_name} FINISHED EARLY*\nUser: {current_user['name']}"
-                            if queue: msg += f"\n👉 Next: *{queue[0]['name']}*"
-                            send_telegram(msg, selected_hostel)
+                        elif pin_matches(pin_input, current_user['pin']):
+                            finished = finish_session(db.transaction(), doc_ref, current_user, now)
+                            fetch_machines.clear()
+                            if finished:
+                                # MANUAL FINISH ALERT
+                                msg = f"✅ *{machine_name} FINISHED EARLY*\nUser: {current_user['name']}"
+                                if queue: msg += f"\n👉 Next: *{queue[0]['name']}*"
+                                send_telegram(msg, selected_hostel)
                             st.rerun()
                         else:
                             st.error("Wrong PIN")
             else:
                 st.success("🟢 AVAILABLE")
                 
+                # The claim buffer only matters when someone is waiting
                 effective_free_time = None
-                if last_free_time_str:
-                    effective_free_time = datetime.fromisoformat(last_free_time_str)
-                elif current_user: 
-                    effective_free_time = datetime.fromisoformat(current_user['end_time'])
+                if queue:
+                    if last_free_time:
+                        effective_free_time = last_free_time
+                    elif current_user: 
+                        effective_free_time = end_time
 
                 timeout_happened = False
                 if queue and effective_free_time:
                     buffer_deadline = effective_free_time + timedelta(minutes=BUFFER_MINUTES)
-                    mins_left = int((buffer_deadline - get_current_time()).total_seconds() / 60)
+                    mins_left = int((buffer_deadline - now).total_seconds() / 60)
                     
                     if mins_left > 0:
                         st.warning(f"⏳ **{queue[0]['name']}** has {mins_left} mins to claim.")
@@ -795,40 +982,14 @@ for i, machine_name in enumerate(MACHINES):
                         
                         if len(queue) == 1:
                             timed_out_user = queue.pop(0)
-                            doc_ref.update({"queue": queue, "last_free_time": get_current_time().isoformat()})
+                            doc_ref.update({"queue": firestore.ArrayRemove([timed_out_user]), "last_free_time": now})
+                            fetch_machines.clear()
                             send_telegram(f"⚠️ *Queue Alert*\n{timed_out_user['name']} timed out and was automatically removed from the queue for {machine_name}.", selected_hostel)
                             st.rerun()
 
             # --- QUEUE DISPLAY ---
             if queue:
-                st.divider()
-                st.write(f"**Queue ({len(queue)})**")
-                for idx, q_user in enumerate(queue):
-                    urgency_icon = "🔥" if q_user.get('urgent') else ""
-                    desig_str = q_user.get('designation', '')
-                    name_str = f"{q_user['name']} ({desig_str})" if desig_str else q_user['name']
-                    
-                    with st.expander(f"{idx+1}. {name_str} {urgency_icon}"):
-                        if q_user.get('urgent_reason'):
-                            st.markdown(f":fire: <span class='urgent-text'>{q_user['urgent_reason']}</span>", unsafe_allow_html=True)
-                        if q_user.get('comment'):
-                            st.info(f"📝 Note: {q_user['comment']}")
-                        
-                        action_pin = st.text_input("PIN", type="password", key=f"qpin_{machine_name}_{idx}")
-                        c_swap, c_leave = st.columns(2)
-                        
-                        if idx < len(queue) - 1:
-                            if c_swap.button(f"▼ Swap Down", key=f"swap_{machine_name}_{idx}"):
-                                if action_pin == q_user['pin'] or action_pin == MASTER_PIN:
-                                    queue[idx], queue[idx+1] = queue[idx+1], queue[idx]
-                                    doc_ref.update({"queue": queue})
-                                    st.rerun()
-                        
-                        if c_leave.button("❌ Leave", key=f"lv_{machine_name}_{idx}"):
-                            if action_pin == q_user['pin'] or action_pin == MASTER_PIN:
-                                queue.pop(idx)
-                                doc_ref.update({"queue": queue})
-                                st.rerun()
+                render_queue(queue, doc_ref, machine_name)
 
             # --- ACTION BUTTONS ---
             st.divider()
@@ -844,22 +1005,28 @@ for i, machine_name in enumerate(MACHINES):
                     st.write(f"**{queue[0]['name']} missed their turn.**")
                     if st.button(f"🚀 Skip to {queue[1]['name']}", key=f"skip_{machine_name}"):
                          timed_out_user = queue.pop(0)
-                         doc_ref.update({"queue": queue, "last_free_time": get_current_time().isoformat()})
+                         doc_ref.update({"queue": firestore.ArrayRemove([timed_out_user]), "last_free_time": now})
+                         fetch_machines.clear()
                          send_telegram(f"⚠️ *Queue Alert*\n{timed_out_user['name']} timed out.\n👉 Next: {queue[0]['name']} starts now.", selected_hostel)
                          st.rerun()
 
-                if st.button(f"Start ({queue[0]['name']})", use_container_width=True, key=f"btn_sq_{machine_name}"):
-                    st.session_state['active_action'] = {'type': 'Start Queue', 'machine_name': machine_name, 'queue_0_name': queue[0]['name']}
-                    st.rerun()
+                st.button(f"Start ({queue[0]['name']})", use_container_width=True, key=f"btn_sq_{machine_name}", on_click=set_session_value, args=('active_action', {'type': 'Start Queue', 'machine_name': machine_name, 'queue_0_name': queue[0]['name']}))
             else:
-                if st.button("Start Machine", use_container_width=True, key=f"btn_sf_{machine_name}"):
-                    st.session_state['active_action'] = {'type': 'Start Machine', 'machine_name': machine_name}
-                    st.rerun()
+                st.button("Start Machine", use_container_width=True, key=f"btn_sf_{machine_name}", on_click=set_session_value, args=('active_action', {'type': 'Start Machine', 'machine_name': machine_name}))
 
             if show_join:
-                if st.button("Join Queue", use_container_width=True, key=f"btn_jq_{machine_name}"):
-                    st.session_state['active_action'] = {'type': 'Join Queue', 'machine_name': machine_name}
-                    st.rerun()
+                st.button("Join Queue", use_container_width=True, key=f"btn_jq_{machine_name}", on_click=set_session_value, args=('active_action', {'type': 'Join Queue', 'machine_name': machine_name}))
+
+if expiry_alerts:
+    fetch_machines.clear()
+    try:
+        expiry_batch.commit()
+    except exceptions.FailedPrecondition:
+        # Another viewer already flagged (and announced) it, or the document changed; re-check next run
+        expiry_alerts = []
+    if expiry_alerts:
+        # Machines that expired together are announced in one message
+        send_telegram("\n\n".join(expiry_alerts), selected_hostel)
 
 # --- CUSTOM JS ---
 custom_js = """